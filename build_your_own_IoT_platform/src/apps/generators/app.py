@@ -1,69 +1,120 @@
-import asyncio, os, random, time, json
+import asyncio, os, random, time
+import orjson
+import numpy as np
+try:
+    from numba import njit
+except ImportError:  # fall back to plain NumPy draws
+    njit = None
 from nats.aio.client import Client as NATS
 from nats.js.client import JetStreamContext
 
 NATS_URL = os.getenv("NATS_URL","nats://localhost:4222")
 COUNTS = {"camera":300,"fas":150,"ac":200,"mv":30,"pm":800,"light":200,"water":150,"iaq":100,"oura":100,"net":200}
+# device ids never change, so build each population's id strings once instead of per event
+IDS = {k: [f"{p}-{i}" for i in range(COUNTS[k])] for k,p in {"camera":"cam","fas":"fas","ac":"ac","mv":"mv","pm":"pm","light":"light","water":"water","iaq":"iaq","oura":"oura","net":"net"}.items()}
+DOORS = [f"d-{i}" for i in range(20)]
+BURST_MAX = 32      # events emitted per wakeup (and JetStream acks in flight)...
+BURST_WINDOW = 1.0  # ...as long as one burst covers at most this many seconds of the stream
+GAUSS_BATCH = 256  # samples drawn per refill of a gauss_stream
 
 async def setup_streams(js: JetStreamContext):
     await js.add_stream(name="FR", subjects=["fr.*"])
     await js.add_stream(name="BMS", subjects=["bms.*"])
     await js.add_stream(name="CLOUD", subjects=["iaq","oura","netlog"])
 
+_dumps = orjson.dumps  # returns bytes, ready to publish
+
 def now_ms(): return int(time.time()*1000)
-def rand_email(): return ''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=8)) + "@example.com"
+def new_email(): return ''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=8)) + "@example.com"
+_EMAIL_POOL = [new_email() for _ in range(4096)]
+def rand_email(): return random.choice(_EMAIL_POOL)
 def jittered(i): return i*random.uniform(0.8,1.2)
 
+if njit:
+    @njit(cache=True)
+    def _fill_gauss(base, sigma, out):
+        for i in range(out.size): out[i] = base + sigma*np.random.standard_normal()
+else:
+    def _fill_gauss(base, sigma, out): out[:] = np.random.normal(base, sigma, out.size)
+
+def gauss_stream(base, sigma, ndigits=2):
+    # yields rounded N(base, sigma) samples, drawn GAUSS_BATCH at a time instead of one random.gauss per event
+    out = np.empty(GAUSS_BATCH)
+    while True:
+        _fill_gauss(base, sigma, out); yield from np.round(out, ndigits).tolist()
+
+def burst_size(interval): return max(1, min(BURST_MAX, int(BURST_WINDOW/interval)))
+
+async def ticks(window):
+    # one wakeup per jittered window on an absolute schedule, so time spent publishing doesn't
+    # stretch the period; after a stall the missed ticks are skipped rather than fired back-to-back
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time() + random.uniform(0, window)  # spread stream phases apart
+    while True:
+        await asyncio.sleep(max(0, next_tick-loop.time()))
+        yield
+        next_tick = max(next_tick + jittered(window), loop.time())
+
+async def publish_burst(js, subj, payloads):
+    # fire the whole burst and await its JetStream acks together
+    await asyncio.gather(*[js.publish(subj, p) for p in payloads])
+
 async def publish_loop(js, subj, make_event, rate_hz, population, stop_fraction=0.02, drift_fraction=0.02):
     stopped = set(random.sample(range(population), max(1,int(population*stop_fraction))))
     drifted = set(random.sample([i for i in range(population) if i not in stopped], max(1,int(population*drift_fraction))))
     base_interval = 1.0/rate_hz if rate_hz>0 else 60.0
-    while True:
-        idx = random.randrange(population)
-        if idx in stopped and random.random()<0.98:
-            await asyncio.sleep(jittered(base_interval)); continue
-        payload = make_event(idx, drift=(idx in drifted))
-        await js.publish(subj, payload.encode())
-        await asyncio.sleep(jittered(base_interval))
-
-def make_camera(i, drift=False):
+    k = burst_size(base_interval); step_ms = base_interval*1000
+    async for _ in ticks(base_interval*k):  # one timer per burst of k events
+        ts = now_ms(); payloads = []
+        for n in range(k):
+            idx = random.randrange(population)
+            if idx in stopped and random.random()<0.98: continue
+            # stagger timestamps back over the window just slept through
+            payloads.append(make_event(idx, ts-int((k-1-n)*step_ms), drift=(idx in drifted)))
+        await publish_burst(js, subj, payloads)
+
+def make_camera(i, ts, drift=False):
     conf = max(0.0, min(1.0, random.gauss(0.9,0.05)))
     if drift: conf = max(0.0, min(1.0, random.gauss(0.4,0.15)))
-    return json.dumps({"device_id":f"cam-{i}","ts":now_ms(),"email":rand_email(),"confidence":round(conf,3),"location":"lobby"})
+    return _dumps({"device_id":IDS["camera"][i],"ts":ts,"email":rand_email(),"confidence":round(conf,3),"location":"lobby"})
 
-def make_fas(i, drift=False):
+def make_fas(i, ts, drift=False):
     res = "ALLOW" if random.random()>0.1 else "DENY"
-    return json.dumps({"device_id":f"fas-{i}","ts":now_ms(),"email":rand_email(),"result":res,"door_id":f"d-{i%20}"})
-
-def metric_event(dev_id, metric, base, sigma, drift=False):
-    val = random.gauss(base, sigma)
-    if drift and metric=="TEMP": val = base + random.uniform(5,10)
-    return json.dumps({"device_id":dev_id,"ts":now_ms(),"metric":metric,"value":round(val,2)})
-
-def make_ac(i, drift=False): return metric_event(f"ac-{i}","TEMP",24,1.0,drift)
-def make_mv(i, drift=False): return metric_event(f"mv-{i}","HUM",55,3.0,drift)
-def make_pm(i, drift=False): return metric_event(f"pm-{i}","KW",2.5,0.2,drift)
-def make_light(i, drift=False): return metric_event(f"light-{i}","LUX",300,20,drift)
-def make_water(i, drift=False): return metric_event(f"water-{i}","WATER",0.8,0.1,drift)
-def make_iaq(i, drift=False):
-    co2 = max(350, int(random.gauss(700,50)))
+    return _dumps({"device_id":IDS["fas"][i],"ts":ts,"email":rand_email(),"result":res,"door_id":DOORS[i%20]})
+
+def metric_event(dev_id, metric, base, vals, ts, drift=False):
+    val = next(vals)
+    if drift and metric=="TEMP": val = round(base + random.uniform(5,10), 2)
+    return _dumps({"device_id":dev_id,"ts":ts,"metric":metric,"value":val})
+
+_AC, _MV, _PM = gauss_stream(24,1.0), gauss_stream(55,3.0), gauss_stream(2.5,0.2)
+_LIGHT, _WATER = gauss_stream(300,20), gauss_stream(0.8,0.1)
+def make_ac(i, ts, drift=False): return metric_event(IDS["ac"][i],"TEMP",24,_AC,ts,drift)
+def make_mv(i, ts, drift=False): return metric_event(IDS["mv"][i],"HUM",55,_MV,ts,drift)
+def make_pm(i, ts, drift=False): return metric_event(IDS["pm"][i],"KW",2.5,_PM,ts,drift)
+def make_light(i, ts, drift=False): return metric_event(IDS["light"][i],"LUX",300,_LIGHT,ts,drift)
+def make_water(i, ts, drift=False): return metric_event(IDS["water"][i],"WATER",0.8,_WATER,ts,drift)
+
+_CO2, _PM25, _IAQ_TEMP = gauss_stream(700,50,0), gauss_stream(8,2,1), gauss_stream(24,1,1)
+def make_iaq(i, ts, drift=False):
+    co2 = max(350, int(next(_CO2)))
     if drift: co2 = int(random.gauss(2000,150))
-    pm25 = max(0.1, random.gauss(8,2)); temp = random.gauss(24,1)
-    return json.dumps({"device_id":f"iaq-{i}","ts":now_ms(),"co2_ppm":co2,"pm25":round(pm25,1),"temp_c":round(temp,1)})
+    pm25 = max(0.1, next(_PM25)); temp = next(_IAQ_TEMP)
+    return _dumps({"device_id":IDS["iaq"][i],"ts":ts,"co2_ppm":co2,"pm25":pm25,"temp_c":temp})
 
-def make_oura_v1(i, drift=False):
+def make_oura_v1(i, ts, drift=False):
     hr = int(max(40, random.gauss(70,5))); steps = int(max(0, random.gauss(50,30)))
-    return json.dumps({"user_id":f"oura-{i}","ts":now_ms(),"email":rand_email(),"hr":hr,"steps":steps})
+    return _dumps({"user_id":IDS["oura"][i],"ts":ts,"email":rand_email(),"hr":hr,"steps":steps})
 
-def make_oura_v2(i, drift=False):
+def make_oura_v2(i, ts, drift=False):
     hr = int(max(40, random.gauss(70,5))); steps = int(max(0, random.gauss(50,30)))
     hrv = int(max(10, random.gauss(65,10))) if random.random()>0.2 else None
     skin = round(random.gauss(33.5,0.3),1) if random.random()>0.2 else None
-    return json.dumps({"user_id":f"oura-{i}","ts":now_ms(),"email":rand_email(),"hr":hr,"steps":steps,"hrv_ms":hrv,"skin_temp_c":skin})
+    return _dumps({"user_id":IDS["oura"][i],"ts":ts,"email":rand_email(),"hr":hr,"steps":steps,"hrv_ms":hrv,"skin_temp_c":skin})
 
-def make_net(i, drift=False):
+def make_net(i, ts, drift=False):
     status = "OK" if random.random()>0.95 else ("WARN" if random.random()>0.5 else "ERR")
-    return json.dumps({"device_id":f"net-{i}","ts":now_ms(),"bytes_in":random.randint(1000,100000),"bytes_out":random.randint(1000,100000),"status":status})
+    return _dumps({"device_id":IDS["net"][i],"ts":ts,"bytes_in":random.randint(1000,100000),"bytes_out":random.randint(1000,100000),"status":status})
 
 async def main():
     nc = NATS(); await nc.connect(servers=[NATS_URL]); js = nc.jetstream(); await setup_streams(js)
@@ -78,12 +129,15 @@ async def main():
     tasks.append(asyncio.create_task(publish_loop(js, "iaq", make_iaq, rate_hz=(100/300), population=COUNTS["iaq"])))
     async def oura_loop():
         i = 0
-        while True:
-            idx = i % COUNTS["oura"]
-            maker = make_oura_v2 if (i % 5 == 0) else make_oura_v1
-            await js.publish("oura", maker(idx).encode())
-            i += 1
-            await asyncio.sleep(jittered(60/(20*COUNTS["oura"])))
+        interval = 60/(20*COUNTS["oura"]); k = burst_size(interval)
+        async for _ in ticks(interval*k):
+            ts = now_ms(); payloads = []
+            for n in range(k):
+                idx = i % COUNTS["oura"]
+                maker = make_oura_v2 if (i % 5 == 0) else make_oura_v1
+                payloads.append(maker(idx, ts-int((k-1-n)*interval*1000)))
+                i += 1
+            await publish_burst(js, "oura", payloads)
     tasks.append(asyncio.create_task(oura_loop()))
     tasks.append(asyncio.create_task(publish_loop(js, "netlog", make_net, rate_hz=(200/60), population=COUNTS["net"])))
     await asyncio.gather(*tasks)
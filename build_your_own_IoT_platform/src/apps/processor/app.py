@@ -1,22 +1,36 @@
-import os, json, time, io, asyncio
+import os, time, io, asyncio, threading, signal, base64, itertools, functools
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+from collections import defaultdict
 from nats.aio.client import Client as NATS
 from fastavro import parse_schema, schemaless_writer
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 from minio import Minio
-from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 NATS_URL = os.getenv("NATS_URL","nats://localhost:4222")
 MONGO_URL = os.getenv("MONGO_URL","mongodb://localhost:27017")
+MONGO_W = os.getenv("MONGO_W","1")  # write concern for ingest batches: a node count or "majority"
 MINIO_ENDPOINT=os.getenv("MINIO_ENDPOINT","minio:9000")
 MINIO_ACCESS_KEY=os.getenv("MINIO_ACCESS_KEY","minio")
 MINIO_SECRET_KEY=os.getenv("MINIO_SECRET_KEY","minio12345")
 MINIO_BUCKET=os.getenv("MINIO_BUCKET","raw")
-FERNET = Fernet(Fernet.generate_key())  # demo only
+FLUSH_DOCS = 100     # insert a subject's pending Mongo docs once this many are buffered
+FLUSH_INTERVAL = 0.2 # ...or at least this often (seconds)
+RAW_BATCH = 500      # upload a subject's raw Avro object once it holds this many records
+RAW_INTERVAL = 1.0   # ...or at least this often (seconds)
+QUEUE_SIZE = 500     # messages waiting per subject before the subscription callback blocks
+WORKERS = 16         # concurrent normalizers per subject
+IO_THREADS = 32      # blocking Mongo/MinIO calls, on their own pool so they never queue normalize
+SHUTDOWN_TIMEOUT = 8.0  # drain budget on stop, kept under docker's default 10s grace period
+AEAD = AESGCM(AESGCM.generate_key(bit_length=128))  # demo only
+_NONCES = itertools.count()  # a counter nonce never repeats under this process's key
 
 import pathlib
 SCHEMA_DIR = pathlib.Path("/app/schemas")
 def load(name):
-    with open(SCHEMA_DIR/name) as f: return parse_schema(json.load(f))
+    with open(SCHEMA_DIR/name, "rb") as f: return parse_schema(orjson.loads(f.read()))
 CAM = load("facial_camera.avsc")
 FAS = load("fas.avsc")
 BMS = load("bms.avsc")
@@ -25,54 +39,181 @@ OURA_V1 = load("oura_v1.avsc")
 OURA_V2 = load("oura_v2.avsc")
 NET = load("netlog.avsc")
 
-def enc(s: str)->str: return FERNET.encrypt(s.encode()).decode()
+def enc(s: str)->str:
+    nonce = next(_NONCES).to_bytes(12,"big")
+    return base64.b64encode(nonce + AEAD.encrypt(nonce, s.encode(), None)).decode()
+_TLS = threading.local()
 def to_avro_bytes(rec, schema):
-    bio = io.BytesIO(); schemaless_writer(bio, schema, rec); return bio.getvalue()
-def put_raw(minio, prefix, payload):
-    from datetime import datetime
-    ts = datetime.utcnow().strftime("%Y/%m/%d/%H/%M")
-    name = f"{prefix}/{ts}/{int(time.time()*1000)}.avro"
-    minio.put_object(MINIO_BUCKET, name, io.BytesIO(payload), len(payload))
-    return name
+    # one BytesIO per thread, rewound between records instead of allocated per message
+    bio = getattr(_TLS, "bio", None)
+    if bio is None: bio = _TLS.bio = io.BytesIO()
+    bio.seek(0); bio.truncate(); schemaless_writer(bio, schema, rec); return bio.getvalue()
+class RawBatcher:
+    """Packs each subject's Avro records into one in-memory object of length-prefixed
+    frames and uploads it with a single put_object per batch."""
+    def __init__(self, minio):
+        self.minio = minio
+        self.bufs, self.counts = defaultdict(io.BytesIO), defaultdict(int)
+    def add(self, subj, payload):
+        """Append a record; True once the subject's batch is full."""
+        buf = self.bufs[subj]; buf.write(len(payload).to_bytes(4,"big")); buf.write(payload)
+        self.counts[subj] += 1
+        return self.counts[subj] >= RAW_BATCH
+    def take(self, subj):
+        """Detach the subject's pending batch so new records start a fresh one."""
+        self.counts.pop(subj, None); return self.bufs.pop(subj, None)
+    def upload(self, subj, buf):
+        from datetime import datetime
+        ts = datetime.utcnow().strftime("%Y/%m/%d/%H/%M")
+        name = f"{subj.replace('.','/')}/{ts}/{int(time.time()*1000)}.avro"
+        size = buf.getbuffer().nbytes; buf.seek(0)
+        self.minio.put_object(MINIO_BUCKET, name, buf, size)
+        return name
+
+def _build_cam(j): return {"device_id":j["device_id"],"ts":j["ts"],"email_enc":enc(j["email"]),"confidence":float(j["confidence"]),"location":j["location"]}, CAM
+def _build_fas(j): return {"device_id":j["device_id"],"ts":j["ts"],"email_enc":enc(j["email"]),"result":j["result"],"door_id":j["door_id"]}, FAS
+def _build_bms(j): return {"device_id":j["device_id"],"ts":j["ts"],"metric":j["metric"],"value":float(j["value"])}, BMS
+def _build_iaq(j): return {"device_id":j["device_id"],"ts":j["ts"],"co2_ppm":int(j["co2_ppm"]),"pm25":float(j["pm25"]),"temp_c":float(j["temp_c"])}, IAQ
+def _build_oura(j):
+    base={"user_id":j["user_id"],"ts":j["ts"],"email_enc":enc(j["email"]),"hr":int(j["hr"]),"steps":int(j["steps"])}
+    if "hrv_ms" in j or "skin_temp_c" in j:
+        base["hrv_ms"]=j.get("hrv_ms"); base["skin_temp_c"]=j.get("skin_temp_c")
+        return base, OURA_V2  # oura schema evolution: v2 events carry the extra fields
+    return base, OURA_V1
+def _build_net(j): return {"device_id":j["device_id"],"ts":j["ts"],"bytes_in":int(j["bytes_in"]),"bytes_out":int(j["bytes_out"]),"status":j["status"]}, NET
+
+# each builder returns (record, schema to write it with)
+_HANDLERS = {
+    "fr.camera": _build_cam,
+    "fr.fas": _build_fas,
+    "bms.ac": _build_bms,
+    "bms.mv": _build_bms,
+    "bms.pm": _build_bms,
+    "bms.light": _build_bms,
+    "bms.water": _build_bms,
+    "iaq": _build_iaq,
+    "oura": _build_oura,
+    "netlog": _build_net,
+}
 
 def normalize(kind, j):
-    if kind=="fr.camera":
-        return to_avro_bytes({"device_id":j["device_id"],"ts":j["ts"],"email_enc":enc(j["email"]),"confidence":float(j["confidence"]),"location":j["location"]}, CAM)
-    if kind=="fr.fas":
-        return to_avro_bytes({"device_id":j["device_id"],"ts":j["ts"],"email_enc":enc(j["email"]),"result":j["result"],"door_id":j["door_id"]}, FAS)
-    if kind.startswith("bms."):
-        return to_avro_bytes({"device_id":j["device_id"],"ts":j["ts"],"metric":j["metric"],"value":float(j["value"])}, BMS)
-    if kind=="iaq":
-        return to_avro_bytes({"device_id":j["device_id"],"ts":j["ts"],"co2_ppm":int(j["co2_ppm"]),"pm25":float(j["pm25"]),"temp_c":float(j["temp_c"])}, IAQ)
-    if kind=="oura":
-        base={"user_id":j["user_id"],"ts":j["ts"],"email_enc":enc(j["email"]),"hr":int(j["hr"]),"steps":int(j["steps"])}
-        if "hrv_ms" in j or "skin_temp_c" in j:
-            base["hrv_ms"]=j.get("hrv_ms"); base["skin_temp_c"]=j.get("skin_temp_c")
-            return to_avro_bytes(base, OURA_V2)
-        return to_avro_bytes(base, OURA_V1)
-    if kind=="netlog":
-        return to_avro_bytes({"device_id":j["device_id"],"ts":j["ts"],"bytes_in":int(j["bytes_in"]),"bytes_out":int(j["bytes_out"]),"status":j["status"]}, NET)
-    raise ValueError("unknown kind "+kind)
+    try: build = _HANDLERS[kind]
+    except KeyError: raise ValueError("unknown kind "+kind) from None
+    rec, schema = build(j)
+    return to_avro_bytes(rec, schema)
 
 async def main():
     nc = NATS(); await nc.connect(servers=[NATS_URL]); js = nc.jetstream()
-    mongo = MongoClient(MONGO_URL).fake_lake
+    loop = asyncio.get_running_loop()
+    # normalize stays on the default executor; store round-trips get their own threads
+    io_pool = ThreadPoolExecutor(IO_THREADS, thread_name_prefix="store")
+    def store(fn, *args, **kw): return loop.run_in_executor(io_pool, functools.partial(fn, *args, **kw))
+    # one shared client for every worker thread; keep a warm connection per subject so
+    # the first flushes don't pay a handshake (the pool cap stays at pymongo's default)
+    mongo = MongoClient(MONGO_URL, w=int(MONGO_W) if MONGO_W.isdigit() else MONGO_W,
+                        minPoolSize=len(_HANDLERS)).fake_lake
     minio = Minio(MINIO_ENDPOINT, access_key=MINIO_ACCESS_KEY, secret_key=MINIO_SECRET_KEY, secure=False)
-    async def handle(msg):
-        subj = msg.subject
-        j = json.loads(msg.data.decode())
+    raw = RawBatcher(minio)
+    buf_docs, buf_msgs = defaultdict(list), defaultdict(list)  # buf_docs holds (doc, msg) pairs
+    writes = defaultdict(set)  # in-flight Mongo inserts per subject
+    # id()s of messages whose doc reached neither its collection nor dead_letter; each message
+    # stays in buf_msgs until its flush_raw reads and clears its entry, so the id can't be reused
+    failed = set()
+    async def dead_docs(subj, rejected):
+        if not rejected: return
         try:
-            payload = normalize(subj, j)
-            doc = j.copy(); doc.pop("email", None); doc["_raw_avro_len"]=len(payload)
-            mongo[subj.replace('.','_')].insert_one(doc)
-            put_raw(minio, subj.replace('.','/'), payload)
+            await store(mongo["dead_letter"].insert_many, [{"subject":subj,"error":err,"raw":d} for (d, _), err in rejected])
+        except Exception:
+            failed.update(id(m) for (_, m), _ in rejected); raise
+    async def write_docs(subj, pending):
+        if not pending: return
+        try:
+            await store(mongo[subj.replace('.','_')].insert_many, [d for d, _ in pending], ordered=False)
+        except BulkWriteError as e:
+            # unordered insert: every doc without a write error is already in the collection
+            await dead_docs(subj, [(pending[w["index"]], w["errmsg"]) for w in e.details.get("writeErrors", [])])
         except Exception as e:
-            mongo["dead_letter"].insert_one({"subject":subj,"error":str(e),"raw":j})
-        await msg.ack()
-    for s in ["fr.camera","fr.fas","bms.ac","bms.mv","bms.pm","bms.light","bms.water","iaq","oura","netlog"]:
-        await js.subscribe(s, durable="proc_"+s.replace('.','_'), cb=handle, manual_ack=True, ack_wait=30)
+            await dead_docs(subj, [(p, str(e)) for p in pending])
+    def flush_docs(subj):
+        t = asyncio.create_task(write_docs(subj, buf_docs.pop(subj, [])))
+        writes[subj].add(t); t.add_done_callback(writes[subj].discard)
+        return t
+    async def flush_raw(subj):
+        # ack only once both the message's doc and its raw frame are written
+        buf, msgs = raw.take(subj), buf_msgs.pop(subj, [])
+        if not msgs: return
+        flush_docs(subj)
+        # the Mongo and MinIO writes are independent round-trips, overlap them
+        up, *_ = await asyncio.gather(store(raw.upload, subj, buf), *writes[subj], return_exceptions=True)
+        stored = True
+        if isinstance(up, Exception):
+            # keep the batch itself: its length-prefixed frames go to dead_letter
+            try:
+                await store(mongo["dead_letter"].insert_one, {"subject":subj,"error":str(up),"records":len(msgs),"avro_frames":buf.getvalue()})
+            except Exception as e:
+                print(f"flush {subj}: {e!r}"); stored = False
+        # anything not safely stored is nak'd so JetStream redelivers it
+        for m in msgs:
+            ok = stored and id(m) not in failed; failed.discard(id(m))
+            await (m.ack() if ok else m.nak())
+    async def docs_flusher():
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try: await asyncio.gather(*[flush_docs(subj) for subj in list(buf_docs)])
+            except Exception as e: print(f"docs flusher: {e!r}")
+    async def raw_flusher():
+        while True:
+            await asyncio.sleep(RAW_INTERVAL)
+            try: await asyncio.gather(*[flush_raw(subj) for subj in list(buf_msgs)])
+            except Exception as e: print(f"raw flusher: {e!r}")
+    async def worker(subj, q):
+        while True:
+            msg = await q.get()
+            try:
+                try:
+                    j = orjson.loads(msg.data)
+                except orjson.JSONDecodeError as e:
+                    await store(mongo["dead_letter"].insert_one, {"subject":subj,"error":str(e),"raw":msg.data})
+                    await msg.ack(); continue
+                try:
+                    payload = await asyncio.to_thread(normalize, subj, j)
+                except Exception as e:
+                    await store(mongo["dead_letter"].insert_one, {"subject":subj,"error":str(e),"raw":j})
+                    await msg.ack(); continue
+                doc = j.copy(); doc.pop("email", None); doc["_raw_avro_len"]=len(payload)
+                buf_docs[subj].append((doc, msg)); buf_msgs[subj].append(msg)
+                if raw.add(subj, payload): await flush_raw(subj)
+                elif len(buf_docs[subj])>=FLUSH_DOCS: await flush_docs(subj)
+            except Exception as e:
+                # a worker must outlive any single message or store failure, or the subject stalls;
+                # an unacked message is redelivered after ack_wait
+                print(f"worker {subj}: {e!r}")
+            finally:
+                q.task_done()
+    queues = {s: asyncio.Queue(maxsize=QUEUE_SIZE) for s in _HANDLERS}
+    async def handle(msg):
+        await queues[msg.subject].put(msg)
+    tasks = [asyncio.create_task(docs_flusher()), asyncio.create_task(raw_flusher())]
+    for s, q in queues.items():
+        tasks += [asyncio.create_task(worker(s, q)) for _ in range(WORKERS)]
+    subs = [await js.subscribe(s, durable="proc_"+s.replace('.','_'), cb=handle, manual_ack=True, ack_wait=30) for s in _HANDLERS]
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
     print("processor running")
-    while True: await asyncio.sleep(1)
+    await stop.wait()
+    # stop deliveries, let the workers empty their queues, then write and ack whatever is still buffered
+    async def drain():
+        for sub in subs: await sub.unsubscribe()
+        await asyncio.gather(*[q.join() for q in queues.values()])
+        await asyncio.gather(*[flush_raw(subj) for subj in list(buf_msgs)])
+    try:
+        await asyncio.wait_for(drain(), SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print("processor: drain timed out, unacked messages will be redelivered")
+    finally:
+        for t in tasks: t.cancel()
+        await nc.close()
+        io_pool.shutdown(wait=False)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
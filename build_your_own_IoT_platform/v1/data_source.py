@@ -1,8 +1,8 @@
 from dataclasses import dataclass, field
 from datetime import datetime
 from typing import List
+import asyncio
 import random
-import time
 
 DATA_VELOCITY_MAX = 2.0
 DATA_VELOCITY_MIN = 0.5
@@ -14,9 +14,15 @@ class DataSchema:
     temperature: float = field(default_factory=lambda: random.uniform(15.0, 30.0))
 
     
-def data_generator():
+async def data_generator():
     data_velocity = random.uniform(DATA_VELOCITY_MIN,DATA_VELOCITY_MAX)
     data = DataSchema()
 
-    time.sleep(data_velocity)
-    return data
\ No newline at end of file
+    await asyncio.sleep(data_velocity)
+    return data
+
+async def run(n):
+    """
+    drive n devices concurrently on one event loop.
+    """
+    return await asyncio.gather(*[data_generator() for _ in range(n)])
\ No newline at end of file
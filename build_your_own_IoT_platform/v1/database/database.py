@@ -1,8 +1,9 @@
 """
 json file as a database
 """
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from pathlib import Path
+import asyncio
 import json
 DATABASE_PATH = Path('/home/darius/ddia/build_your_own_IoT_platform/v1/database/database.json')
 
@@ -14,14 +15,27 @@ def create_database():
     if not DATABASE_PATH.exists():
         DATABASE_PATH.touch() 
 
-def post_database(data:dataclass):
-    data_json = asdict(data)
-    print("data_json:",data_json)
-    with DATABASE_PATH.open("w", encoding="utf-8") as f:
-        json.dump(data_json, f, indent=2)
-
-def read_database():
-    with DATABASE_PATH.open("r", encoding="utf-8") as f:
-        loaded = json.load(f)
+async def post_database(*data:dataclass):
+    """
+    append records as json lines, the file is never rewritten.
+    a batch goes out in a single write, run in a worker thread.
+    """
+    await asyncio.to_thread(_append, data)
 
+def _append(data:tuple):
+    rows = [{"device_id":d.device_id,"timestamp":d.timestamp,"temperature":d.temperature} for d in data]
+    print("data_json:",rows)
+    buf = bytearray()
+    for row in rows:
+        buf += json.dumps(row, separators=(",",":")).encode(); buf += b"\n"
+    with DATABASE_PATH.open("ab") as f:
+        f.write(buf)
 
+def read_database():
+    """
+    stream records back one json line at a time.
+    """
+    with DATABASE_PATH.open("rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
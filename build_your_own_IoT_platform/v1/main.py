@@ -1,22 +1,25 @@
 """
 The everything 
 """
-from data_source import data_generator
+import asyncio
+from data_source import run
 from database.database import (create_database,post_database,read_database)
 
-def main():
+DEVICES = 3
+
+async def main():
     count = 10
     counter = 0
+    read = False
     create_database()
     while True:
-        if counter == count:
-            read_database()
-        data = data_generator()
-        post_database(data)
-        counter+=1
+        if counter >= count and not read:
+            print("records:", sum(1 for _ in read_database()))
+            read = True
+        await post_database(*await run(DEVICES))
+        counter+=DEVICES
 
 
 
 if __name__ == "__main__":
-    main()
-
+    asyncio.run(main())